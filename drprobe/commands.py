@@ -5,15 +5,168 @@ Created on Mon Apr  4 09:56:58 2016
 @author: fwinkler
 """
 
+import concurrent.futures
+import functools
+import itertools
+import numbers
 import os
 import re
-import numpy as np
+import shlex
+import shutil
 import subprocess
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 
-def cellmuncher(cel_file, output_file, attach_cel=None, attach_direction=None,
-                repeat=None, set_dwf=None, frozen_lattice=None, remove_close_atoms=None,
-                sort=None, cif=False, override=False, output=False):
+# Command line switches of the Dr. Probe tools, given as (argument name, switch, kind). Kind
+# 'bool' switches are passed when the argument is True, all others when it is not None: 'value'
+# followed by the argument, 'csv' by its comma-separated items and 'pair' by both its items.
+_Switches = Tuple[Tuple[str, str, str], ...]
+
+_CELSLC_SWITCHES: _Switches = (
+    ('nv', '-nv', 'value'), ('buni', '-buni', 'value'), ('abf', '-abf', 'value'),
+    ('inf', '-inf', 'value'), ('ssc', '-ssc', 'value'), ('prj', '-prj', 'csv'),
+    ('tla', '-tla', 'csv'), ('rev', '-rev', 'bool'), ('fl', '-fl', 'bool'),
+    ('dwf', '-dwf', 'bool'), ('absorb', '-abs', 'bool'), ('pot', '-pot', 'bool'),
+    ('_3dp', '-3dp', 'bool'), ('pps', '-pps', 'bool'), ('rti', '-rti', 'bool'),
+    ('silent', '-silent', 'bool'))
+
+_MSA_SWITCHES: _Switches = (
+    ('input_image', '-in', 'value'), ('inw', '-inw', 'pair'), ('px', '-px', 'value'),
+    ('py', '-py', 'value'), ('lx', '-lx', 'value'), ('ly', '-ly', 'value'),
+    ('foc', '-foc', 'value'), ('tx', '-tx', 'value'), ('ty', '-ty', 'value'),
+    ('otx', '-otx', 'value'), ('oty', '-oty', 'value'), ('sr', '-sr', 'value'),
+    ('abf', '-abf', 'value'), ('buni', '-buni', 'value'), ('uuni', '-uuni', 'value'),
+    ('vtx', '/vtx', 'value'), ('detslc', '-detslc', 'value'), ('kmom', '-kmom', 'pair'),
+    ('ctem', '/ctem', 'bool'), ('txtout', '/txtout', 'bool'), ('_3dout', '/3dout', 'bool'),
+    ('gaussap', '/gaussap', 'bool'), ('wave', '/wave', 'bool'), ('avwave', '/avwave', 'bool'),
+    ('detimg', '/detimg', 'bool'), ('verbose', '/verbose', 'bool'), ('debug', '/debug', 'bool'),
+    ('lapro', '/lapro', 'bool'), ('waveft', '/waveft', 'bool'),
+    ('avwaveft', '/avwaveft', 'bool'), ('pdif', '/pdif', 'bool'), ('pimg', '/pimg', 'bool'),
+    ('epc', '/epc', 'bool'), ('padif', '/padif', 'bool'), ('silavwave', '/silavwave', 'bool'),
+    ('silavwaveft', '/silavwaveft', 'bool'), ('silent', '/silent', 'bool'),
+    ('rti', '/rti', 'bool'))
+
+_WAVIMG_SWITCHES: _Switches = (
+    ('btx', '-btx', 'value'), ('bty', '-bty', 'value'), ('foc', '-foc', 'value'),
+    ('oar', '-oar', 'value'), ('sbshx', '-sbshx', 'value'), ('sbshy', '-sbshy', 'value'),
+    ('sil', '/sil', 'bool'), ('dbg', '/dbg', 'bool'), ('nli', '/nli', 'bool'),
+    ('rnsb', '/rnsb', 'bool'), ('rti', '/rti', 'bool'))
+
+
+def _ensure_dir(directory: str) -> None:
+    """
+    Creates 'directory' if necessary. Recently seen directories are not checked again, so a
+    folder deleted during the session is not recreated.
+    """
+    if directory:
+        # Relative names are resolved first, so that they are checked again after os.chdir
+        _make_dir(os.path.abspath(directory))
+
+
+@functools.lru_cache(maxsize=256)
+def _make_dir(directory: str) -> None:
+    """Creates the absolute path 'directory' and its parents if they do not exist."""
+    os.makedirs(directory, exist_ok=True)
+
+
+# Separator of the entries in a line of a Dr. Probe parameter file
+_PRM_SPLIT_RE = re.compile(r'[,\s]\s*')
+
+# Image output directories read from wavimg parameter files, keyed by file name. The stored
+# modification time, size and inode detect a parameter file rewritten in a sweep, which then
+# replaces its entry.
+_PRM_DIR_CACHE: Dict[str, Tuple[Tuple[int, int, int], str]] = {}
+
+
+def _wavimg_output_dir(prm_file: str) -> str:
+    """Returns the directory of the image output files defined in a wavimg parameter file."""
+    stat = os.stat(prm_file)
+    signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    cached = _PRM_DIR_CACHE.get(prm_file)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    # The output file name is the first entry in the 6th line of the parameter file
+    with open(prm_file, 'r') as prm:
+        line = next(itertools.islice(prm, 5, None), '')
+    directory = os.path.dirname(_PRM_SPLIT_RE.split(line, maxsplit=1)[0]).replace("'", "")
+    _PRM_DIR_CACHE[prm_file] = (signature, directory)
+    return directory
+
+
+# Return value of the command wrappers: None, the started process (defer=True) or the command
+# (return_command=True)
+_Result = Optional[Union[subprocess.Popen, List[str]]]
+
+
+@functools.lru_cache(maxsize=None)
+def _which(program: str, path: Optional[str]) -> str:
+    """
+    Returns the absolute path of 'program' found in 'path', or 'program' if it is not found.
+    Relative results (e.g. from the current directory or a relative PATH entry) are made
+    absolute, so that the cached path stays valid after os.chdir.
+    """
+    executable = shutil.which(program, path=path)
+    return os.path.abspath(executable) if executable else program
+
+
+def _run(parts: List[str], output: bool = False, defer: bool = False,
+         env: Optional[Dict[str, str]] = None) -> Optional[subprocess.Popen]:
+    """
+    Runs the command given by the argument list 'parts'. The console output of the process is
+    captured and only printed if 'output' is True. Raises a RuntimeError if the process exits
+    with a non-zero status. If 'defer' is True, the process is only started and its
+    subprocess.Popen object is returned.
+    """
+    # Look up the Dr. Probe executable only once instead of searching PATH for every process
+    executable = _which(parts[0], (os.environ if env is None else env).get('PATH'))
+    if defer and not output:
+        return subprocess.Popen(parts, executable=executable, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL, env=env)
+
+    # The console output is hidden, so an interactive prompt (e.g. CellMuncher asking before
+    # overwriting a file) gets end of input instead of blocking without visible reason
+    result = subprocess.run(parts, executable=executable, stdin=subprocess.DEVNULL,
+                            capture_output=True, encoding='utf-8', errors='replace', env=env)
+    if output:
+        print(f'Performed {parts[0]} with the following command:\n', shlex.join(parts))
+        print(result.stdout)
+    if result.returncode != 0:
+        # The Dr. Probe tools write most error messages to stdout
+        raise RuntimeError(f'{shlex.join(parts)} failed with exit status {result.returncode}:\n'
+                           f'{result.stderr or result.stdout}')
+    return None
+
+
+def _as_list_of_tuples(pairs: Sequence) -> Sequence:
+    """Wraps a single (key, value) pair into a list. Lists of pairs are returned unchanged."""
+    return [pairs] if isinstance(pairs[0], str) else pairs
+
+
+def _add_options(parts: List[str], options: Dict[str, Any], switches: _Switches) -> None:
+    """Appends the switches set in 'options' to the argument list 'parts'."""
+    for name, switch, kind in switches:
+        value = options[name]
+        if kind == 'bool':
+            if value:
+                parts.append(switch)
+        elif value is not None:
+            if kind == 'value':
+                parts += (switch, str(value))
+            elif kind == 'csv':
+                parts += (switch, ','.join(map(str, value)))
+            else:
+                parts += (switch, str(value[0]), str(value[1]))
+
+
+def cellmuncher(cel_file: str, output_file: str, attach_cel: Optional[str] = None,
+                attach_direction: Optional[str] = None, repeat: Optional[Sequence] = None,
+                set_dwf: Optional[Sequence] = None,
+                frozen_lattice: Optional[Union[str, Sequence[str]]] = None,
+                remove_close_atoms: Optional[Union[float, Sequence]] = None,
+                sort: Optional[Sequence[str]] = None, cif: bool = False, override: bool = False,
+                output: bool = False, defer: bool = False,
+                env: Optional[Dict[str, str]] = None,
+                return_command: bool = False) -> _Result:
     """
     Runs cellmuncher. Supports only a few basic options at the moment.
 
@@ -47,54 +200,64 @@ def cellmuncher(cel_file, output_file, attach_cel=None, attach_direction=None,
         Export cif file
     override : bool, optional
         Overrides output file without asking
+    output : bool, optional
+        Flag for terminal output
+    defer : bool, optional
+        Starts the process and returns its subprocess.Popen object without waiting for it to
+        finish. The console output of the process is discarded. Ignored if output is True.
+    env : dict, optional
+        Environment variables of the process. Defaults to the environment of the Python
+        process.
+    return_command : bool, optional
+        Returns the command as a list of arguments instead of running it, e.g. to submit it to a
+        job scheduler. Output folders are created nevertheless.
     """
 
-    _command = "CellMuncher -f {} -o {}".format(cel_file, output_file)
+    parts = ["CellMuncher", "-f", cel_file, "-o", output_file]
 
     if cif:
-        _command += ' --cif'
+        parts.append('--cif')
     if attach_cel is not None:
-        _command += ' --attach-cel={},XMS,{}'.format(attach_cel, attach_direction)
+        parts.append(f'--attach-cel={attach_cel},XMS,{attach_direction}')
     if repeat is not None:
-        repeat = np.atleast_2d(repeat)
-        for r in repeat:
-            _command += ' --repeat={},{}'.format(r[0], r[1])
+        for r in _as_list_of_tuples(repeat):
+            parts.append(f'--repeat={r[0]},{r[1]}')
     if set_dwf is not None:
-        set_dwf = np.atleast_2d(set_dwf)
-        for d in set_dwf:
-            _command += ' --set-dw-factor={},{}'.format(d[0], d[1])
+        for d in _as_list_of_tuples(set_dwf):
+            parts.append(f'--set-dw-factor={d[0]},{d[1]}')
     if frozen_lattice is not None:
-        frozen_lattice = np.atleast_1d(frozen_lattice)
-        fl_str = ''
-        for f in frozen_lattice:
-            fl_str += '{},'.format(f)
-        fl_str = fl_str[:-1]
-        _command += ' --frozen-lattice={}'.format(fl_str)
+        if isinstance(frozen_lattice, str):
+            frozen_lattice = [frozen_lattice]
+        parts.append('--frozen-lattice=' + ','.join(map(str, frozen_lattice)))
     if remove_close_atoms is not None:
-        remove_close_atoms = np.atleast_1d(remove_close_atoms)
-        if len(remove_close_atoms) == 1:
-            _command += ' --remove-close-atoms={}'.format(remove_close_atoms[0])
-        elif len(remove_close_atoms) == 2:
-            _command += ' --remove-close-atoms={},{}'.format(remove_close_atoms[0],
-                                                            remove_close_atoms[1])
+        # Scalars (also NumPy scalars) are wrapped, any other sequence, e.g. an array, is indexed
+        close_atoms: Any = remove_close_atoms
+        if isinstance(close_atoms, (numbers.Real, str)):
+            close_atoms = [close_atoms]
+        if len(close_atoms) == 1:
+            parts.append(f'--remove-close-atoms={close_atoms[0]}')
+        elif len(close_atoms) == 2:
+            parts.append(f'--remove-close-atoms={close_atoms[0]},{close_atoms[1]}')
     if sort is not None:
-        for item in sort:
-            _command += ' -s={}'.format(item)
+        parts += [f'-s={item}' for item in sort]
     if override:
-        _command += ' --override'
+        parts.append('--override')
 
     # Run the cellmuncher command
-    if output:
-        co = subprocess.check_output(_command, shell=True)
-        print('Performed cellmuncher with the following command:\n', _command)
-        print(co.decode('utf-8'))
-    else:
-        subprocess.call(_command, shell=True)
+    if return_command:
+        return parts
+    return _run(parts, output, defer, env)
 
 
-def celslc(cel_file, slice_name, ht, nx=None, ny=None, nz=None, abf=None, absorb=False,
-           dwf=False, buni=None, fl=False, nv=None, pot=False, pps=False, prj=None, rev=False,
-           ssc=None, tla=None, _3dp=False, inf=None, rti=False, silent=False, output=False):
+def celslc(cel_file: str, slice_name: str, ht: Union[int, float], nx: Optional[int] = None,
+           ny: Optional[int] = None, nz: Optional[int] = None, abf: Optional[float] = None,
+           absorb: bool = False, dwf: bool = False, buni: Optional[float] = None,
+           fl: bool = False, nv: Optional[int] = None, pot: bool = False, pps: bool = False,
+           prj: Optional[Sequence[float]] = None, rev: bool = False, ssc: Optional[int] = None,
+           tla: Optional[Sequence[float]] = None, _3dp: bool = False, inf: Optional[int] = None,
+           rti: bool = False, silent: bool = False, output: bool = False, defer: bool = False,
+           env: Optional[Dict[str, str]] = None,
+           return_command: bool = False) -> _Result:
     """
     Runs celslc from Dr. Probe.
     Requires installation of Dr Probe command line tools.
@@ -178,81 +341,58 @@ def celslc(cel_file, slice_name, ht, nx=None, ny=None, nz=None, abf=None, absorb
         If True, fully deactivate terminal output.
     output : bool, optional
         Activates terminal output of celslc command.
+    defer : bool, optional
+        Starts the process and returns its subprocess.Popen object without waiting for it to
+        finish. The console output of the process is discarded. Ignored if output is True.
+    env : dict, optional
+        Environment variables of the process. Defaults to the environment of the Python
+        process.
+    return_command : bool, optional
+        Returns the command as a list of arguments instead of running it, e.g. to submit it to a
+        job scheduler. Output folders are created nevertheless.
     """
 
-    #_celslc_options = {}
     if cel_file.endswith('.cel') or cel_file.endswith('.txt'):
-        _command = "celslc -cel {} ".format(cel_file)
+        parts = ["celslc", "-cel", cel_file]
     elif cel_file.endswith('.cif'):
-        _command = "celslc -cif {} ".format(cel_file)
+        parts = ["celslc", "-cif", cel_file]
     else:
-        _command = "celslc -cel {} ".format(cel_file)
+        parts = ["celslc", "-cel", cel_file]
 
     if inf is None:
-        _command += " -slc {} -nx {} -ny {} -nz {} -ht {}".format(slice_name, nx, ny, nz, ht)
+        parts += ("-slc", slice_name, "-nx", str(nx), "-ny", str(ny), "-nz", str(nz),
+                  "-ht", str(ht))
     else:
-        _command += " -slc {} -ht {}".format(slice_name, ht)
+        parts += ("-slc", slice_name, "-ht", str(ht))
 
     # If necessary, create folder for output slices.
-    directory = os.path.split(slice_name)[0]
-    if directory:
-        if not os.path.isdir(directory):
-            os.makedirs(directory, exist_ok=True)
-
-    if rev:
-        _command += ' -rev'
-    if fl:
-        _command += ' -fl'
-    if nv is not None:
-        _command += ' -nv {}'.format(nv)
-    if dwf:
-        _command += ' -dwf'
-    if buni is not None:
-        _command += ' -buni {}'.format(buni)
-    if absorb:
-        _command += ' -abs'
-    if abf is not None:
-        _command += ' -abf {}'.format(abf)
-    if pot:
-        _command += ' -pot'
-    if _3dp:
-        _command += ' -3dp'
-    if inf is not None:
-        _command += ' -inf {}'.format(inf)
-    if pps:
-        _command += ' -pps'
-    if ssc is not None:
-        _command += ' -ssc {}'.format(ssc)
-    if rti:
-        _command += ' -rti'
-    if silent:
-        _command += ' -silent'
-    if prj is not None:
-        _prj = ' -prj '
-        for i in prj:
-            _prj += '{},'.format(i)
-        _command += _prj[:-1]
-    if tla is not None:
-        _tla = ' -tla '
-        for i in tla:
-            _tla += '{},'.format(i)
-        _command += _tla[:-1]
+    _ensure_dir(os.path.dirname(slice_name))
+
+    options = dict(nv=nv, buni=buni, abf=abf, inf=inf, ssc=ssc, prj=prj, tla=tla, rev=rev, fl=fl,
+                   dwf=dwf, absorb=absorb, pot=pot, _3dp=_3dp, pps=pps, rti=rti, silent=silent)
+    _add_options(parts, options, _CELSLC_SWITCHES)
 
     # Run the celslc command
-    if output:
-        co = subprocess.check_output(_command, shell=True)
-        print('Performed celslc with the following command:\n', _command)
-        print(co.decode('utf-8'))
-    else:
-        subprocess.call(_command, shell=True)
+    if return_command:
+        return parts
+    return _run(parts, output, defer, env)
 
 
-def msa(prm_file, output_file, input_image=None, inw=None, px=None, py=None, lx=None, ly=None,
-        foc=None, tx=None, ty=None, otx=None, oty=None, sr=None, abf=None, buni=None, uuni=None,
-        ctem=False, txtout=False, _3dout=False, gaussap=False, wave=False, avwave=False,
-        detimg=False, verbose=False, debug=False, lapro=False, waveft=False, avwaveft=False,
-        pdif=False, pimg=False, epc=False, vtx=None, detslc=None, kmom=None,
-        padif=False, silavwave=False, silavwaveft=False, silent=False, rti=False, output=False):
+def msa(prm_file: str, output_file: str, input_image: Optional[str] = None,
+        inw: Optional[Tuple[str, int]] = None, px: Optional[int] = None, py: Optional[int] = None,
+        lx: Optional[int] = None, ly: Optional[int] = None, foc: Optional[float] = None,
+        tx: Optional[float] = None, ty: Optional[float] = None, otx: Optional[float] = None,
+        oty: Optional[float] = None, sr: Optional[float] = None, abf: Optional[float] = None,
+        buni: Optional[float] = None, uuni: Optional[float] = None, ctem: bool = False,
+        txtout: bool = False, _3dout: bool = False, gaussap: bool = False, wave: bool = False,
+        avwave: bool = False, detimg: bool = False, verbose: bool = False, debug: bool = False,
+        lapro: bool = False, waveft: bool = False, avwaveft: bool = False, pdif: bool = False,
+        pimg: bool = False, epc: bool = False, vtx: Optional[int] = None,
+        detslc: Optional[str] = None, kmom: Optional[Tuple[int, float]] = None,
+        padif: bool = False, silavwave: bool = False, silavwaveft: bool = False,
+        silent: bool = False, rti: bool = False, output: bool = False, defer: bool = False,
+        env: Optional[Dict[str, str]] = None,
+        return_command: bool = False) -> _Result:
     """
     Runs msa from Dr. Probe
 
@@ -393,105 +533,44 @@ def msa(prm_file, output_file, input_image=None, inw=None, px=None, py=None, lx=
         Run time information.
     output : bool, optional
         Flag for terminal output
+    defer : bool, optional
+        Starts the process and returns its subprocess.Popen object without waiting for it to
+        finish. The console output of the process is discarded. Ignored if output is True.
+    env : dict, optional
+        Environment variables of the process. Defaults to the environment of the Python
+        process.
+    return_command : bool, optional
+        Returns the command as a list of arguments instead of running it, e.g. to submit it to a
+        job scheduler. Output folders are created nevertheless.
     """
 
-    _command = "msa -prm {} -out {}".format(prm_file, output_file)
+    parts = ["msa", "-prm", prm_file, "-out", output_file]
 
     # Make folder for the output files if it doesn't exist already
-    directory = os.path.split(output_file)[0]
-    if directory:
-        if not os.path.isdir(directory):
-            os.makedirs(directory, exist_ok=True)
-
-    if input_image is not None:
-        _command += ' -in {}'.format(input_image)
-    if inw is not None:
-        _command += ' -inw {} {}'.format(inw[0], inw[1])
-    if px is not None:
-        _command += ' -px {}'.format(px)
-    if py is not None:
-        _command += ' -py {}'.format(py)
-    if lx is not None:
-        _command += ' -lx {}'.format(lx)
-    if ly is not None:
-        _command += ' -ly {}'.format(ly)
-    if foc is not None:
-        _command += ' -foc {}'.format(foc)
-    if tx is not None:
-        _command += ' -tx {}'.format(tx)
-    if ty is not None:
-        _command += ' -ty {}'.format(ty)
-    if otx is not None:
-        _command += ' -otx {}'.format(otx)
-    if oty is not None:
-        _command += ' -oty {}'.format(oty)
-    if sr is not None:
-        _command += ' -sr {}'.format(sr)
-    if abf is not None:
-        _command += ' -abf {}'.format(abf)
-    if buni is not None:
-        _command += ' -buni {}'.format(buni)
-    if uuni is not None:
-        _command += ' -uuni {}'.format(uuni)
-    if ctem:
-        _command += ' /ctem'
-    if txtout:
-        _command += ' /txtout'
-    if _3dout:
-        _command += ' /3dout'
-    if gaussap:
-        _command += ' /gaussap'
-    if wave:
-        _command += ' /wave'
-    if avwave:
-        _command += ' /avwave'
-    if detimg:
-        _command += ' /detimg'
-    if verbose:
-        _command += ' /verbose'
-    if debug:
-        _command += ' /debug'
-    if lapro:
-        _command += ' /lapro'
-    if waveft:
-        _command += ' /waveft'
-    if avwaveft:
-        _command += ' /avwaveft'
-    if pdif:
-        _command += ' /pdif'
-    if pimg:
-        _command += ' /pimg'
-    if epc:
-        _command += ' /epc'
-    if vtx is not None:
-        _command += ' /vtx {}'.format(vtx)
-    if detslc is not None:
-        _command += ' -detslc {}'.format(detslc)
-    if kmom is not None:
-        _command += ' -kmom {} {}'.format(kmom[0], kmom[1])
-    if padif:
-        _command += ' /padif'
-    if silavwave:
-        _command += ' /silavwave'
-    if silavwaveft:
-        _command += ' /silavwaveft'
-    if silent:
-        _command += ' /silent'
-    if rti:
-        _command += ' /rti'
+    _ensure_dir(os.path.dirname(output_file))
+
+    options = dict(input_image=input_image, inw=inw, px=px, py=py, lx=lx, ly=ly, foc=foc, tx=tx,
+                   ty=ty, otx=otx, oty=oty, sr=sr, abf=abf, buni=buni, uuni=uuni, vtx=vtx,
+                   detslc=detslc, kmom=kmom, ctem=ctem, txtout=txtout, _3dout=_3dout,
+                   gaussap=gaussap, wave=wave, avwave=avwave, detimg=detimg, verbose=verbose,
+                   debug=debug, lapro=lapro, waveft=waveft, avwaveft=avwaveft, pdif=pdif,
+                   pimg=pimg, epc=epc, padif=padif, silavwave=silavwave, silavwaveft=silavwaveft,
+                   silent=silent, rti=rti)
+    _add_options(parts, options, _MSA_SWITCHES)
 
     # Run msa command
-    if output:
-        co = subprocess.check_output(_command, shell=True)
-        print('Performed msa with the following command:\n', _command)
-        print(co.decode('utf-8'))
-    else:
-        subprocess.call(_command, shell=True)
+    if return_command:
+        return parts
+    return _run(parts, output, defer, env)
 
 
-def wavimg(prm_file, output_file=None, foc=None, btx=None, bty=None, oar=None,
-           sbshx=None, sbshy=None, sil=False, dbg=False, nli=False, rnsb=False,
-           rti=False, output=False):
+def wavimg(prm_file: str, output_file: Optional[str] = None, foc: Optional[float] = None,
+           btx: Optional[float] = None, bty: Optional[float] = None, oar: Optional[float] = None,
+           sbshx: Optional[float] = None, sbshy: Optional[float] = None, sil: bool = False,
+           dbg: bool = False, nli: bool = False, rnsb: bool = False, rti: bool = False,
+           output: bool = False, defer: bool = False,
+           env: Optional[Dict[str, str]] = None,
+           return_command: bool = False) -> _Result:
     """
     Runs wavimg from Dr. Probe
 
@@ -525,52 +604,129 @@ def wavimg(prm_file, output_file=None, foc=None, btx=None, bty=None, oar=None,
         Run time information.
     output : bool, optional
         Flag for terminal output
+    defer : bool, optional
+        Starts the process and returns its subprocess.Popen object without waiting for it to
+        finish. The console output of the process is discarded. Ignored if output is True.
+    env : dict, optional
+        Environment variables of the process. Defaults to the environment of the Python
+        process.
+    return_command : bool, optional
+        Returns the command as a list of arguments instead of running it, e.g. to submit it to a
+        job scheduler. Output folders are created nevertheless.
     """
 
-    _command = "wavimg -prm {}".format(prm_file)
+    parts = ["wavimg", "-prm", prm_file]
 
     # Check if output_file is given as parameter
     if output_file:
-        directory = os.path.split(output_file)[0]
-        _command += ' -out {}'.format(output_file)
+        directory = os.path.dirname(output_file)
+        parts += ('-out', output_file)
     else:
-        with open(prm_file, 'r') as prm:
-            _content = prm.readlines()
-            _content = [re.split(r'[,\s]\s*', line) for line in _content]
-            directory = os.path.split(_content[5][0])[0].replace("'", "")
-
-    if btx is not None:
-        _command += ' -btx {}'.format(btx)
-    if bty is not None:
-        _command += ' -bty {}'.format(bty)
-    if foc is not None:
-        _command += ' -foc {}'.format(foc)
-    if oar is not None:
-        _command += ' -oar {}'.format(oar)
-    if sbshx is not None:
-        _command += ' -sbshx {}'.format(sbshx)
-    if sbshy is not None:
-        _command += ' -sbshy {}'.format(sbshy)
-    if sil:
-        _command += ' /sil'
-    if dbg:
-        _command += ' /dbg'
-    if nli:
-        _command += ' /nli'
-    if rnsb:
-        _command += ' /rnsb'
-    if rti:
-        _command += ' /rti'
+        directory = _wavimg_output_dir(prm_file)
+
+    options = dict(btx=btx, bty=bty, foc=foc, oar=oar, sbshx=sbshx, sbshy=sbshy, sil=sil, dbg=dbg,
+                   nli=nli, rnsb=rnsb, rti=rti)
+    _add_options(parts, options, _WAVIMG_SWITCHES)
 
     # Make folder for output files if it doesn't exist already
-    if directory:
-        if not os.path.isdir(directory):
-            os.makedirs(directory, exist_ok=True)
+    _ensure_dir(directory)
 
     # Run wavimg command
-    if output:
-        co = subprocess.check_output(_command, shell=True)
-        print('Performed wavimg with the following command:\n', _command)
-        print(co.decode('utf-8'))
-    else:
-        subprocess.call(_command, shell=True)
+    if return_command:
+        return parts
+    return _run(parts, output, defer, env)
+
+
+def _run_many(function: Any, jobs: Iterable[Dict[str, Any]], max_workers: Optional[int] = None,
+              threads_per_job: Optional[int] = None) -> List[_Result]:
+    """Calls 'function' once per keyword dictionary in 'jobs', using a pool of threads."""
+    if threads_per_job is not None:
+        env = dict(os.environ, OMP_NUM_THREADS=str(threads_per_job))
+        jobs = [dict({'env': env}, **kwargs) for kwargs in jobs]
+        if max_workers is None:
+            max_workers = max(1, (os.cpu_count() or 1) // threads_per_job)
+    # The threads only wait for the Dr. Probe processes, so a thread pool is sufficient.
+    with concurrent.futures.ThreadPoolExecutor(max_workers or os.cpu_count()) as executor:
+        return list(executor.map(lambda kwargs: function(**kwargs), jobs))
+
+
+def celslc_many(jobs: Iterable[Dict[str, Any]], max_workers: Optional[int] = None,
+                threads_per_job: Optional[int] = None) -> List[_Result]:
+    """
+    Runs several celslc calculations in parallel.
+
+    Parameters
+    ----------
+    jobs : list of dict
+        Keyword arguments of the individual celslc calls, e.g.
+        [{'cel_file': 'a.cel', 'slice_name': 'slc/a', 'ht': 300, 'nx': 256, 'ny': 256, 'nz': 4},
+         ...]
+    max_workers : int, optional
+        Maximum number of celslc processes running at the same time. Defaults to the number of
+        CPUs.
+    threads_per_job : int, optional
+        Number of threads each process may use, passed to the Dr. Probe tools as
+        OMP_NUM_THREADS. If given, max_workers defaults to the number of CPUs divided by
+        threads_per_job, e.g. 4 processes with 4 threads each on 16 CPUs.
+    """
+    return _run_many(celslc, jobs, max_workers, threads_per_job)
+
+
+def msa_many(jobs: Iterable[Dict[str, Any]], max_workers: Optional[int] = None,
+             threads_per_job: Optional[int] = None) -> List[_Result]:
+    """
+    Runs several msa calculations in parallel, e.g. for a scan over probe positions.
+
+    Parameters
+    ----------
+    jobs : list of dict
+        Keyword arguments of the individual msa calls, e.g.
+        [{'prm_file': 'msa.prm', 'output_file': 'wav/px0.wav', 'px': 0}, ...]
+    max_workers : int, optional
+        Maximum number of msa processes running at the same time. Defaults to the number of
+        CPUs.
+    threads_per_job : int, optional
+        Number of threads each process may use, passed to the Dr. Probe tools as
+        OMP_NUM_THREADS. If given, max_workers defaults to the number of CPUs divided by
+        threads_per_job, e.g. 4 processes with 4 threads each on 16 CPUs.
+    """
+    return _run_many(msa, jobs, max_workers, threads_per_job)
+
+
+def wavimg_many(jobs: Iterable[Dict[str, Any]], max_workers: Optional[int] = None,
+                threads_per_job: Optional[int] = None) -> List[_Result]:
+    """
+    Runs several wavimg calculations in parallel, e.g. for a focal series.
+
+    Parameters
+    ----------
+    jobs : list of dict
+        Keyword arguments of the individual wavimg calls, e.g.
+        [{'prm_file': 'wavimg.prm', 'output_file': 'img/foc0.dat', 'foc': 0}, ...]
+    max_workers : int, optional
+        Maximum number of wavimg processes running at the same time. Defaults to the number of
+        CPUs.
+    threads_per_job : int, optional
+        Number of threads each process may use, passed to the Dr. Probe tools as
+        OMP_NUM_THREADS. If given, max_workers defaults to the number of CPUs divided by
+        threads_per_job, e.g. 4 processes with 4 threads each on 16 CPUs.
+    """
+    return _run_many(wavimg, jobs, max_workers, threads_per_job)
+
+
+def wait_all(processes: Iterable[subprocess.Popen]) -> List[int]:
+    """
+    Waits until all processes started with defer=True have finished.
+
+    Parameters
+    ----------
+    processes : list of subprocess.Popen
+        Process objects returned by cellmuncher, celslc, msa or wavimg when called with
+        defer=True.
+
+    Returns
+    -------
+    list of int
+        Exit codes of the processes.
+    """
+    return [process.wait() for process in processes]
@@ -7,10 +7,71 @@ Created on Mon Apr  4 15:00:02 2016
 @author: fwinkler
 """
 
-import numpy as np
-import re
+import itertools
+import mmap
+import numbers
 import os
-from functools import reduce
+
+
+# Names of the aberrations, indexed by their Dr. Probe aberration index
+_ABERRATION_LABELS = ('image_shift', 'defocus', '2-fold-astigmatism', 'coma', '3-fold-astigmatism',
+                      'CS', 'star_aberration', '4-fold-astigmatism', 'coma(5th)',
+                      'lobe-aberration', '5-fold-astigmatism', 'C5')
+
+# Parameters of MsaPrm and their default values
+_DEFAULTS = (('conv_semi_angle', 30), ('inner_radius_ann_det', 0), ('outer_radius_ann_det', 30),
+             ('detector', (0, "prm/msa_det.prm")), ('wavelength', 0.00417571),
+             ('source_radius', 0.01), ('focus_spread', 3), ('focus_spread_kernel_hw', 2),
+             ('focus_spread_kernel_size', 7), ('tilt_x', 0), ('tilt_y', 0), ('h_scan_offset', 0),
+             ('v_scan_offset', 0), ('h_scan_frame_size', 1), ('v_scan_frame_size', 1),
+             ('scan_frame_rot', 0), ('scan_columns', 0), ('scan_rows', 0),
+             ('temp_coherence_flag', 0), ('spat_coherence_flag', 1), ('super_cell_x', 1),
+             ('super_cell_y', 1), ('super_cell_z', 1), ('slice_files', "slc/slices"),
+             ('number_of_slices', 5), ('number_frozen_lattice', 1), ('min_num_frozen', 1),
+             ('det_readout_period', 1), ('tot_number_of_slices', 10))
+
+# Lines of the parameter file given by a single attribute, as (attribute, format, comment). The
+# microscope parameters follow the convergence angle, the multislice parameters start the
+# multislice section.
+_MICROSCOPE_ROWS = (
+    ('inner_radius_ann_det', '{}', "Inner radius of the annular detector [mrad]"),
+    ('outer_radius_ann_det', '{}', "Outer radius of the annular detector [mrad]"),
+    ('detector', "{0[0]}, '{0[1]}'", "Detector definition file, switch and file name"),
+    ('wavelength', '{}', "Electron wavelength [nm]"),
+    ('source_radius', '{}', "De-magnified source radius (1/e half width) [nm]"),
+    ('focus_spread', '{}', "Focus spread [nm]"),
+    ('focus_spread_kernel_hw', '{}', "Focus-spread kernel half-width w.r.t. the focus spread"),
+    ('focus_spread_kernel_size', '{}', "Focus-spread kernel size"),
+    ('number_of_aberrations', '{}', "Number of aberration definitions following"))
+
+_MULTISLICE_ROWS = (
+    ('tilt_x', '{}', "Object tilt X [deg]. Approximative approach. Do not use for tilts larger "
+                     "than 5 degrees."),
+    ('tilt_y', '{}', "Object tilt Y [deg]. Approximative approach. Do not use for tilts larger "
+                     "than 5 degrees."),
+    ('h_scan_offset', '{}', "Horizontal scan frame offset [nm]."),
+    ('v_scan_offset', '{}', "Vertical scan frame offset [nm]."),
+    ('h_scan_frame_size', '{}', "Horizontal scan frame size [nm]."),
+    ('v_scan_frame_size', '{}', "Vertical scan frame size [nm]."),
+    ('scan_frame_rot', '{}', "Scan frame rotation [deg] w.r.t. the slice data."),
+    ('scan_columns', '{}',
+     "Number of scan columns = number of pixels on horizontal scan image axis."),
+    ('scan_rows', '{}', "Number of scan rows = number of pixels on vertical scan image axis."),
+    ('temp_coherence_flag', '{}', "Switch for partial temporal coherence calculation. Drastic "
+                                  "increase of calculation time if activated."),
+    ('spat_coherence_flag', '{}', "Switch for partial spatial coherence calculation. Is only "
+                                  "applied in combination with an input image file."),
+    ('super_cell_x', '{}', "Supercell repeat factor in horizontal direction, x."),
+    ('super_cell_y', '{}', "Supercell repeat factor in vertical direction, y."),
+    ('super_cell_z', '{}', "Supercell repeat factor in Z-direction, obsolete."),
+    ('slice_files', "'{}'", "Slice file series name [SFN]. Expected file names are "
+                            "[SFN]+'_###.sli' where ### is a three digit number."),
+    ('number_of_slices', '{}', "Number of slice files to load."),
+    ('number_frozen_lattice', '{}', "Number of frozen lattice variants per slice."),
+    ('min_num_frozen', '{}', "Minimum number of frozen lattice variations averaged per scan "
+                             "pixel in STEM mode."),
+    ('det_readout_period', '{}', "Detector readout period in slices."),
+    ('tot_number_of_slices', '{}', "Number of slices in the object."))
 
 
 class MsaPrm(object):
@@ -100,6 +161,15 @@ class MsaPrm(object):
         defined by prm_filename.
     """
 
+    __slots__ = ('aberrations_dict', 'conv_semi_angle', 'inner_radius_ann_det',
+                 'outer_radius_ann_det', 'detector', 'wavelength', 'source_radius', 'focus_spread',
+                 'focus_spread_kernel_hw', 'focus_spread_kernel_size', 'tilt_x', 'tilt_y',
+                 'h_scan_offset', 'v_scan_offset', 'h_scan_frame_size', 'v_scan_frame_size',
+                 'scan_frame_rot', 'scan_columns', 'scan_rows', 'temp_coherence_flag',
+                 'spat_coherence_flag', 'super_cell_x', 'super_cell_y', 'super_cell_z',
+                 'slice_files', 'number_of_slices', 'number_frozen_lattice', 'min_num_frozen',
+                 'det_readout_period', 'tot_number_of_slices')
+
     def __init__(self, msa_dict=None, aberrations_dict=None):
         if msa_dict is None:
             msa_dict = {}
@@ -109,45 +179,21 @@ class MsaPrm(object):
         else:
             self.aberrations_dict = aberrations_dict
 
-        self.conv_semi_angle = msa_dict.get('conv_semi_angle', 30)
-        self.inner_radius_ann_det = msa_dict.get('inner_radius_ann_det', 0)
-        self.outer_radius_ann_det = msa_dict.get('outer_radius_ann_det', 30)
-        self.detector = msa_dict.get('detector', (0, "prm/msa_det.prm"))
-        self.wavelength = msa_dict.get('wavelength', 0.00417571)
-        self.source_radius = msa_dict.get('source_radius', 0.01)
-        self.focus_spread = msa_dict.get('focus_spread', 3)
-        self.focus_spread_kernel_hw = msa_dict.get('focus_spread_kernel_hw', 2)
-        self.focus_spread_kernel_size = msa_dict.get('focus_spread_kernel_size', 7)
-        # self.number_of_aber = msa_dict.get('number_of_aber', 0)
-        self.tilt_x = msa_dict.get('tilt_x', 0)
-        self.tilt_y = msa_dict.get('tilt_y', 0)
-        self.h_scan_offset = msa_dict.get('h_scan_offset', 0)
-        self.v_scan_offset = msa_dict.get('v_scan_offset', 0)
-        self.h_scan_frame_size = msa_dict.get('h_scan_frame_size', 1)
-        self.v_scan_frame_size = msa_dict.get('v_scan_frame_size', 1)
-        self.scan_frame_rot = msa_dict.get('scan_frame_rot', 0)
-        self.scan_columns = msa_dict.get('scan_columns', 0)
-        self.scan_rows = msa_dict.get('scan_rows', 0)
-        self.temp_coherence_flag = msa_dict.get('temp_coherence_flag', 0)
-        self.spat_coherence_flag = msa_dict.get('spat_coherence_flag', 1)
-        self.super_cell_x = msa_dict.get('super_cell_x', 1)
-        self.super_cell_y = msa_dict.get('super_cell_y', 1)
-        self.super_cell_z = msa_dict.get('super_cell_z', 1)
-        self.slice_files = msa_dict.get('slice_files', "slc/slices")
-        self.number_of_slices = msa_dict.get('number_of_slices', 5)
-        self.number_frozen_lattice = msa_dict.get('number_frozen_lattice', 1)
-        self.min_num_frozen = msa_dict.get('min_num_frozen', 1)
-        self.det_readout_period = msa_dict.get('det_readout_period', 1)
-        self.tot_number_of_slices = msa_dict.get('tot_number_of_slices', 10)
+        for name, default in _DEFAULTS:
+            setattr(self, name, msa_dict.get(name, default))
 
     @property
     def number_of_aberrations(self):
-        return len(self.aberrations_dict.keys())
+        return len(self.aberrations_dict)
 
     def factors(self, n):
-        return np.sort(list(reduce(list.__add__,
-                                   ([i, n // i] for i in range(1, int(n ** 0.5) + 1) if
-                                    n % i == 0))))
+        import numpy as np
+
+        # Divisors up to sqrt(n) and their complements. The square root of a perfect square is
+        # kept twice, which the selection of the block length in save_msa_prm relies on.
+        small = np.arange(1, int(n ** 0.5) + 1, dtype=np.int64)
+        small = small[n % small == 0]
+        return np.sort(np.concatenate((small, n // small)))
 
     def load_msa_prm(self, prm_filename, output=False):
         """
@@ -162,13 +208,21 @@ class MsaPrm(object):
         """
         aberrations_dict = {}
 
-        with open(prm_filename, 'r') as prm:
-            content = prm.readlines()
-            content = [re.split(r'[,\s]\s*', line) for line in content]
-            if content[1].index('!') == 3:
+        with open(prm_filename, 'rb') as prm, \
+                mmap.mmap(prm.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            # Entries are separated by commas and/or whitespace and followed by a comment after
+            # '!'. Bytes outside ASCII are kept as surrogates, so that saving writes them back.
+            lines = (line.partition(b'!')[0].decode('ascii', 'surrogateescape')
+                     .replace(',', ' ').split() for line in iter(mapped.readline, b''))
+            # Read up to the number of slices in the object, which follows the n aberrations.
+            # The slice IDs after it are not needed.
+            content = list(itertools.islice(lines, 11))
+            n = int(content[10][0])
+            content += itertools.islice(lines, 21 + n)
+            if len(content[1]) == 3:
                 self.conv_semi_angle = (float(content[1][0]), float(content[1][1]),
                                         float(content[1][2]))
-            elif content[1].index('!') == 1:
+            elif len(content[1]) == 1:
                 self.conv_semi_angle = float(content[1][0])
             else:
                 self.conv_semi_angle = 0
@@ -180,7 +234,6 @@ class MsaPrm(object):
             self.focus_spread = float(content[7][0])
             self.focus_spread_kernel_hw = float(content[8][0])
             self.focus_spread_kernel_size = float(content[9][0])
-            n = int(content[10][0])
             # self.number_of_aber = n
             for i in range(n):
                 index = int(content[11 + i][0])
@@ -223,144 +276,72 @@ class MsaPrm(object):
         output : bool, optional
             Flag for terminal output.
         """
+        import numpy as np
 
-        directory = os.path.split(prm_filename)[0]
+        directory = os.path.dirname(prm_filename)
         if directory:
-            if not os.path.isdir(directory):
-                os.makedirs(directory, exist_ok=True)
-
-        aberrations = {0: 'image_shift',
-                       1: 'defocus',
-                       2: '2-fold-astigmatism',
-                       3: 'coma',
-                       4: '3-fold-astigmatism',
-                       5: 'CS',
-                       6: 'star_aberration',
-                       7: '4-fold-astigmatism',
-                       8: 'coma(5th)',
-                       9: 'lobe-aberration',
-                       10: '5-fold-astigmatism',
-                       11: 'C5'}
-
-        with open(prm_filename, 'w') as prm:
-            prm.write("'[Microscope Parameters]'\n")
-            string_0 = "Semi angle of convergence [mrad]"
-            if isinstance(self.conv_semi_angle, (int, float)):
-                prm.write("{} ! {}\n".format(self.conv_semi_angle, string_0))
-            elif isinstance(self.conv_semi_angle, (tuple, list, np.ndarray)):
-                if len(self.conv_semi_angle) == 3:
-                    prm.write("{}, {}, {} ! {}\n".format(self.conv_semi_angle[0],
-                                                         self.conv_semi_angle[1],
-                                                         self.conv_semi_angle[2],
-                                                         string_0))
-            else:
-                prm.write("{} ! {}\n".format(0, string_0))
-            string_1 = "Inner radius of the annular detector [mrad]"
-            prm.write("{} ! {}\n".format(self.inner_radius_ann_det, string_1))
-            string_2 = "Outer radius of the annular detector [mrad]"
-            prm.write("{} ! {}\n".format(self.outer_radius_ann_det, string_2))
-            string_3 = "Detector definition file, switch and file name"
-            prm.write("{}, '{}'! {}\n".format(self.detector[0], self.detector[1], string_3))
-            string_4 = "Electron wavelength [nm]"
-            prm.write("{} ! {}\n".format(self.wavelength, string_4))
-            string_5 = "De-magnified source radius (1/e half width) [nm]"
-            prm.write("{} ! {}\n".format(self.source_radius, string_5))
-            string_6 = "Focus spread [nm]"
-            prm.write("{} ! {}\n".format(self.focus_spread, string_6))
-            string_7 = "Focus-spread kernel half-width w.r.t. the focus spread"
-            prm.write("{} ! {}\n".format(self.focus_spread_kernel_hw, string_7))
-            string_8 = "Focus-spread kernel size"
-            prm.write("{} ! {}\n".format(self.focus_spread_kernel_size, string_8))
-            string_9 = "Number of aberration definitions following"
-            prm.write("{} ! {}\n".format(self.number_of_aberrations, string_9))
-            for key in self.aberrations_dict:
-                prm.write('{} {:.4f} {:.4f} ! {}\n'.format(key, self.aberrations_dict[key][0],
-                                                     self.aberrations_dict[key][1],
-                                                     aberrations[key]))
-            prm.write("'[Multislice Parameters]'\n")
-            string_10 = "Object tilt X [deg]. Approximative approach. Do not use for tilts " \
-                        "larger than 5 degrees."
-            prm.write("{} ! {}\n".format(self.tilt_x, string_10))
-            string_11 = "Object tilt Y [deg]. Approximative approach. Do not use for tilts " \
-                        "larger than 5 degrees."
-            prm.write("{} ! {}\n".format(self.tilt_y, string_11))
-            string_12 = "Horizontal scan frame offset [nm]."
-            prm.write("{} ! {}\n".format(self.h_scan_offset, string_12))
-            string_13 = "Vertical scan frame offset [nm]."
-            prm.write("{} ! {}\n".format(self.v_scan_offset, string_13))
-            string_14 = "Horizontal scan frame size [nm]."
-            prm.write("{} ! {}\n".format(self.h_scan_frame_size, string_14))
-            string_15 = "Vertical scan frame size [nm]."
-            prm.write("{} ! {}\n".format(self.v_scan_frame_size, string_15))
-            string_16 = "Scan frame rotation [deg] w.r.t. the slice data."
-            prm.write("{} ! {}\n".format(self.scan_frame_rot, string_16))
-            string_17 = "Number of scan columns = number of pixels on horizontal scan image axis."
-            prm.write("{} ! {}\n".format(self.scan_columns, string_17))
-            string_18 = "Number of scan rows = number of pixels on vertical scan image axis."
-            prm.write("{} ! {}\n".format(self.scan_rows, string_18))
-            string_19 = "Switch for partial temporal coherence calculation. Drastic increase of " \
-                        "calculation time if activated."
-            prm.write("{} ! {}\n".format(self.temp_coherence_flag, string_19))
-            string_20 = "Switch for partial spatial coherence calculation. Is only applied in " \
-                        "combination with an input image file."
-            prm.write("{} ! {}\n".format(self.spat_coherence_flag, string_20))
-            string_21 = "Supercell repeat factor in horizontal direction, x."
-            prm.write("{} ! {}\n".format(self.super_cell_x, string_21))
-            string_22 = "Supercell repeat factor in vertical direction, y."
-            prm.write("{} ! {}\n".format(self.super_cell_y, string_22))
-            string_23 = "Supercell repeat factor in Z-direction, obsolete."
-            prm.write("{} ! {}\n".format(self.super_cell_z, string_23))
-            string_24 = "Slice file series name [SFN]. Expected file names are [SFN]+'_###.sli' " \
-                        "where ### is a three digit number."
-            prm.write("'{}' ! {}\n".format(self.slice_files, string_24))
-            string_25 = "Number of slice files to load."
-            prm.write("{} ! {}\n".format(self.number_of_slices, string_25))
-            string_26 = "Number of frozen lattice variants per slice."
-            prm.write("{} ! {}\n".format(self.number_frozen_lattice, string_26))
-            string_27 = "Minimum number of frozen lattice variations averaged per scan pixel in " \
-                        "STEM mode."
-            prm.write("{} ! {}\n".format(self.min_num_frozen, string_27))
-            string_28 = "Detector readout period in slices."
-            prm.write("{} ! {}\n".format(self.det_readout_period, string_28))
-            string_29 = "Number of slices in the object."
-            prm.write("{} ! {}\n".format(self.tot_number_of_slices, string_29))
-
-            if random_slices:
-                if self.tot_number_of_slices < self.number_of_slices:
-                    ld = int(self.number_of_slices - self.tot_number_of_slices)
-                    lo = np.random.randint(0, ld)
-                    for i in range(lo, self.tot_number_of_slices + lo):
-                        prm.write("{} ! Slice ID\n".format(i % self.number_of_slices))
-                elif self.tot_number_of_slices >= self.number_of_slices:
-                    fm = self.factors(self.tot_number_of_slices)
-                    idx = int((len(fm) + 1) / 2)
-                    len_div = int(fm[idx])
-                    num_div = int(self.tot_number_of_slices / len_div)
-                    ld = self.number_of_slices - len_div
-                    for j in range(num_div):
-                        lo = np.random.randint(0, ld)
-                        for i in range(lo, len_div + lo):
-                            prm.write("{} ! Slice ID\n".format(i % self.number_of_slices))
+            os.makedirs(directory, exist_ok=True)
+
+        # Lines of the parameter file as (entry, comment). Lines without comment are written as is.
+        rows = [("'[Microscope Parameters]'", None)]
+        string_0 = "Semi angle of convergence [mrad]"
+        # Exactly one line is written, otherwise all following lines would be shifted
+        angle = '0'
+        if isinstance(self.conv_semi_angle, numbers.Real):
+            angle = str(self.conv_semi_angle)
+        elif not isinstance(self.conv_semi_angle, str):
+            try:
+                angles = tuple(self.conv_semi_angle)
+            except TypeError:
+                pass
             else:
-                for i in range(self.tot_number_of_slices):
-                    prm.write("{} ! Slice ID\n".format(i % self.number_of_slices))
-            prm.write("End of parameter file.")
-
-        # Sort prm file
-        with open(prm_filename, 'r+') as prm:
-            content = prm.readlines()
-
-            length = []
-            for line in content:
-                length.append(len(line.split('!')[0]))
-
-            spacer = np.max(length)
-            prm.seek(0)
-            prm.truncate()
-            for line in content:
-                if '!' in line:
-                    line = line.split('!')[0].ljust(spacer) + ' !' + line.split('!')[1]
-                prm.write(line)
+                if len(angles) == 3:
+                    angle = "{}, {}, {}".format(*angles)
+        rows.append((angle, string_0))
+        rows.extend((fmt.format(getattr(self, name)), comment)
+                    for name, fmt, comment in _MICROSCOPE_ROWS)
+        for key, (coeff_1, coeff_2) in sorted(self.aberrations_dict.items()):
+            # Negative keys would silently index the labels from the end
+            if not 0 <= key < len(_ABERRATION_LABELS):
+                raise KeyError(key)
+            rows.append(('{} {:.4f} {:.4f}'.format(key, coeff_1, coeff_2),
+                         _ABERRATION_LABELS[key]))
+        rows.append(("'[Multislice Parameters]'", None))
+        rows.extend((fmt.format(getattr(self, name)), comment)
+                    for name, fmt, comment in _MULTISLICE_ROWS)
+
+        # Indices of the slice files stacked to the object
+        if random_slices:
+            if self.tot_number_of_slices < self.number_of_slices:
+                ld = int(self.number_of_slices - self.tot_number_of_slices)
+                lo = np.random.randint(0, ld)
+                slice_ids = np.arange(lo, self.tot_number_of_slices + lo)
+            elif self.tot_number_of_slices >= self.number_of_slices:
+                fm = self.factors(self.tot_number_of_slices)
+                idx = int((len(fm) + 1) / 2)
+                len_div = int(fm[idx])
+                num_div = int(self.tot_number_of_slices / len_div)
+                ld = self.number_of_slices - len_div
+                # One random start per block, each followed by len_div consecutive slices
+                los = np.random.randint(0, ld, size=num_div)
+                slice_ids = (los[:, np.newaxis] + np.arange(len_div)).ravel()
+        else:
+            slice_ids = np.arange(self.tot_number_of_slices)
+        slice_ids = slice_ids % self.number_of_slices
+
+        # Align the comments in one column behind the longest entry
+        spacer = max(max(len(entry) for entry, comment in rows if comment is not None),
+                     len(str(self.number_of_slices - 1)))
+        lines = [entry + '\n' if comment is None else
+                 '{} ! {}\n'.format(entry.ljust(spacer), comment) for entry, comment in rows]
+        # The Slice ID line of each slice file is formatted once and repeated for the object
+        slice_lines = ['{} ! Slice ID\n'.format(str(i).ljust(spacer))
+                       for i in range(self.number_of_slices)]
+        lines += map(slice_lines.__getitem__, slice_ids.tolist())
+        lines.append("End of parameter file.")
+
+        with open(prm_filename, 'w', encoding='ascii', errors='surrogateescape') as prm:
+            prm.write(''.join(lines))
 
         if output:
             print("Parameters successfully saved to file '{}'!".format(prm_filename))
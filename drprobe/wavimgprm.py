@@ -7,11 +7,133 @@ Created on Mon Apr  4 15:32:35 2016
 @author: fwinkler
 """
 
-import numpy as np
+import concurrent.futures
+import functools
+import itertools
 import re
 import os
+from typing import Any, Dict, Tuple
 
+try:
+    from mypy_extensions import mypyc_attr
+except ImportError:
+    # mypy_extensions is only needed for the optional mypyc build (see setup.py)
+    def mypyc_attr(*attrs, **kwattrs):  # type: ignore[misc]
+        return lambda cls: cls
 
+
+# Separator of the entries in a line of the parameter file: a comma and/or whitespace
+_LINE_SPLIT_RE = re.compile(r'[,\s]\s*')
+
+# Names of the aberrations, indexed by their Dr. Probe aberration index
+_ABERRATION_LABELS = ('image_shift', 'defocus', '2-fold-astigmatism', 'coma', '3-fold-astigmatism',
+                      'CS', 'star_aberration', '4-fold-astigmatism', 'coma(5th)',
+                      'lobe-aberration', '5-fold-astigmatism', 'C5')
+
+# Attributes read from parameter files, keyed by file name. The stored modification time, size
+# and inode detect a parameter file rewritten in a sweep, which then replaces its entry.
+_PRM_CACHE: Dict[str, Tuple[int, int, int, Dict[str, Any]]] = {}
+
+# Comments of the lines in the parameter file
+_COMMENT_1 = "Wave function file name string used to locate existing wave functions. " \
+             "Use quotation marks when the string includes space characters."
+_COMMENT_2 = "Dimension of the wave data in pixels, <nx> = number of horizontal wave " \
+             "pixels, <ny> = number of vertical wave pixels."
+_COMMENT_3 = "Sampling rate of the wave data (<sx> = horizontal, <sy> = vertical) [" \
+             "nm/pix]."
+_COMMENT_4 = "TEM high-tension used for wave function calculation [kV]."
+_COMMENT_5 = "Image output type option: 0 = TEM image, 1 = complex image plane wave, " \
+             "2 = wave amplitude, 3 = wave phase, 4 = wave real part, 5 = wave " \
+             "imaginary part, 6 = TEM image map of 2 variables."
+_COMMENT_6 = "Image output file name string. Use quotation marks when the string " \
+             "includes space characters."
+_COMMENT_7 = "Image output size (<ix> = horizontal , <iy> = vertical) in number of " \
+             "pixels."
+_COMMENT_8 = "Flag and parameters for creating integer images with optional noise. " \
+             "Flag <intflg> 0 = off (default), 1 = 32-bit, 2 = 16-bit, Parameter: " \
+             "<mean> = mean vacuum intensity, <conv> = electron to counts conversion " \
+             "rate, <rnoise> detector readout rms noise level in counts."
+_COMMENT_9 = "Flag activating the extraction of a special image frame (0=OFF, " \
+             "1=ON). The frame parameters are defined in the lines below."
+_COMMENT_10 = "Image output sampling rate [nm/pix], isotropic. The parameter is used " \
+              "only if the Flag in line 09 is set to 1."
+_COMMENT_11 = "Image frame offset in pixels of the input wave. The parameter is used " \
+              "only if the Flag in line 09 is set to 1."
+_COMMENT_12 = "Image frame rotation in [deg] with respect to the input wave " \
+              "horizontal axis. The parameter is used only if the Flag in line 09 is " \
+              "set to 1."
+_COMMENT_13 = "Coherence calculation model switch: 1 = averaging of coherent sub " \
+              "images explicit focal variation but quasi-coherent spatial envelope, " \
+              "2 = averaging of coherent sub images with explicit focal and angular " \
+              "variation, 3 = quasi-coherent linear envelopes, 4 = Fourier-space " \
+              "synthesis with  partially coherent TCC, 5: averaging of coherent sub " \
+              "images with explicit  focal, angular, and frozen lattice variation)."
+_COMMENT_14 = "Flag and parameters for partial temporal coherence: <ptcflg> = flag (" \
+              "0=OFF, 1=ON), <f-spread> = focus spread (1/e) half width [nm]."
+_COMMENT_15 = "Flag and parameters for partial spatial coherence: <pscflg> = flag (" \
+              "0=OFF, 1=ON), <s-conv> = beam convergence (1/e) half width [mrad]."
+_COMMENT_16 = "Flag and parameters for applying the detector MTF: <mtfflag> = flag (" \
+              "0=OFF, 1=ON), <mtf-scale> = calculation scale of the mtf = (sampling " \
+              "rate experiment)/(sampling rate simulation), <mtf-file> = File name " \
+              "string to locate the MTF data. Use quotation marks when the string " \
+              "includes space characters."
+_COMMENT_17 = "Flag and parameters for a vibration envelope: <vibflg> = flag (0=OFF, " \
+              "1=ON-ISO, 2=ON-ANISO), <vibprm1>, <vibprm1> = vibration RMS amplitudes " \
+              "[nm], <vibprm3> = orientation [deg] of the primary vibration amplitude " \
+              "w.r.t. the horizontal image axis."
+_COMMENT_18 = "Number of aberration definitions following this line."
+_COMMENT_19 = "Objective aperture radius [mrad]. Set to very large values to deactivate."
+_COMMENT_20 = "Center of the objective aperture with respect to the zero beam [mrad]."
+_COMMENT_21 = "Number variable of loop definitions following below."
+
+# Lines of the parameter file before and after the aberrations as (attribute, types, comment).
+# Attributes with a single type are scalars, all others tuples. Strings are quoted in the file.
+_SCHEMA_HEAD = (('wave_files', (str,), _COMMENT_1),
+                ('wave_dim', (int, int), _COMMENT_2),
+                ('wave_sampling', (float, float), _COMMENT_3),
+                ('high_tension', (int,), _COMMENT_4),
+                ('output_format', (int,), _COMMENT_5),
+                ('output_files', (str,), _COMMENT_6),
+                ('output_dim', (int, int), _COMMENT_7),
+                ('noise', (int, int, int, int), _COMMENT_8),
+                ('flag_spec_frame', (int,), _COMMENT_9),
+                ('output_sampling', (float,), _COMMENT_10),
+                ('img_frame_offset', (int, int), _COMMENT_11),
+                ('img_rot', (float,), _COMMENT_12),
+                ('coherence_model', (int,), _COMMENT_13),
+                ('temp_coherence', (int, float), _COMMENT_14),
+                ('spat_coherence', (int, float), _COMMENT_15),
+                ('mtf', (int, float, str), _COMMENT_16),
+                ('vibration', (int, float, float, float), _COMMENT_17))
+_SCHEMA_TAIL = (('oa_radius', (float,), _COMMENT_19),
+                ('oa_position', (int, int), _COMMENT_20),
+                ('number_of_loops', (int,), _COMMENT_21))
+
+# Attributes read from a parameter file
+_LOADED_ATTRIBUTES = ('aberrations_dict',) + tuple(name for name, types, comment
+                                                   in _SCHEMA_HEAD + _SCHEMA_TAIL)
+
+
+def _parse_entries(name, tokens, types):
+    """Converts the entries of a parameter file line to the value of attribute 'name'."""
+    if len(tokens) < len(types):
+        raise ValueError(f"Line of '{name}' has {len(tokens)} entries, expected {len(types)}")
+    values = tuple(token.strip("'\"") if kind is str else kind(token)
+                   for kind, token in zip(types, tokens))
+    return values if len(types) > 1 else values[0]
+
+
+def _format_entries(name, value, types):
+    """Formats the value of attribute 'name' as the entries of a parameter file line."""
+    values = value if len(types) > 1 else (value,)
+    if len(values) != len(types):
+        raise ValueError(f"'{name}' has {len(values)} entries, expected {len(types)}")
+    return ', '.join(f"'{entry}'" if kind is str else str(entry)
+                     for kind, entry in zip(types, values))
+
+
+# Keep the compiled class open to subclasses defined in user code
+@mypyc_attr(allow_interpreted_subclasses=True)
 class WavimgPrm(object):
     """
     Wavimg object that can be used to load, modify and save a wavimg parameter
@@ -146,9 +268,17 @@ class WavimgPrm(object):
     save_wavimg_prm(prm_filename)
         Saves a wavimgprm object to a parameterfile. The path and name of the parameterfile is
         defined by prm_filename.
+    load_many(prm_filenames)
+        Creates one wavimgprm object per parameterfile, loading the files in parallel.
 
     """
 
+    __slots__ = ('aberrations_dict', 'wave_files', 'wave_dim', 'wave_sampling', 'high_tension',
+                 'output_format', 'output_files', 'output_dim', 'noise', 'flag_spec_frame',
+                 'output_sampling', 'img_frame_offset', 'img_rot', 'coherence_model',
+                 'temp_coherence', 'spat_coherence', 'mtf', 'vibration', 'oa_radius',
+                 'oa_position', 'number_of_loops')
+
     def __init__(self, wavimg_dict=None, aberrations_dict=None):
         if wavimg_dict is None:
             wavimg_dict = {}
@@ -181,10 +311,10 @@ class WavimgPrm(object):
         self.number_of_loops = wavimg_dict.get('number_of_loops', 0)
 
     @property
-    def number_of_aberrations(self):
-        return len(self.aberrations_dict.keys())
+    def number_of_aberrations(self) -> int:
+        return len(self.aberrations_dict)
 
-    def load_wavimg_prm(self, prm_filename, output=False):
+    def load_wavimg_prm(self, prm_filename, output=False, use_cache=True):
         """
         Loads the parameterfile 'prm_filename' .
 
@@ -194,47 +324,75 @@ class WavimgPrm(object):
             The name of the parameterfile.
         output : bool, optional
             Flag for terminal output.
+        use_cache : bool, optional
+            Reuses the attributes of a previous load of the same, unmodified parameterfile
+            instead of parsing it again.
         """
-        aberrations_dict = {}
-
-        with open(prm_filename, 'r') as prm:
-            # rad content from prm file and split at comma and/or spaces
-            content = prm.readlines()
-            content = [re.split(r'[,\s]\s*', line) for line in content]
-            # read lines to dictionary wavimg_dict
-            self.wave_files = content[0][0]
-            self.wave_dim = (int(content[1][0]), int(content[1][1]))
-            self.wave_sampling = (float(content[2][0]), float(content[2][1]))
-            self.high_tension = int(content[3][0])
-            self.output_format = int(content[4][0])
-            self.output_files = content[5][0]
-            self.output_dim = (int(content[6][0]), int(content[6][1]))
-            self.noise = (int(content[7][0]), int(content[7][1]), int(content[7][2]),
-                          int(content[7][3]))
-            self.flag_spec_frame = int(content[8][0])
-            self.output_sampling = float(content[9][0])
-            self.img_frame_offset = (int(content[10][0]), int(content[10][1]))
-            self.img_rot = float(content[11][0])
-            self.coherence_model = int(content[12][0])
-            self.temp_coherence = (int(content[13][0]), float(content[13][1]))
-            self.spat_coherence = (int(content[14][0]), float(content[14][1]))
-            self.mtf = (int(content[15][0]), float(content[15][1]), content[15][2])
-            self.vibration = (int(content[16][0]), float(content[16][1]), float(content[16][2]),
-                              float(content[16][3]))
-            n = int(content[17][0])
-            # self.number_of_aber = n
-            for i in range(n):
-                index = int(content[18 + i][0])
-                aberrations_dict[index] = (float(content[18 + i][1]), float(content[18 + i][2]))
-            #self.number_of_aber = int(content[17][0])
-            self.aberrations_dict = aberrations_dict
-            self.oa_radius = float(content[18 + n][0])
-            self.oa_position = (int(content[19 + n][0]), int(content[19 + n][1]))
-            self.number_of_loops = int(content[20 + n][0])
+        stat = os.stat(prm_filename)
+        signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        cached = _PRM_CACHE.get(prm_filename) if use_cache else None
+        if cached is not None and cached[:3] == signature:
+            for name, value in cached[3].items():
+                setattr(self, name, value)
+            self.aberrations_dict = dict(self.aberrations_dict)
+        else:
+            aberrations_dict = {}
+
+            # Line ends are left to the separator, which includes '\r'. Bytes outside ASCII, e.g.
+            # in file names, are kept as surrogates, so that saving writes them back unchanged.
+            with open(prm_filename, 'r', encoding='ascii', errors='surrogateescape',
+                      newline='') as prm:
+                # rad content from prm file, cut off the comments and split at comma and/or spaces
+                lines = (_LINE_SPLIT_RE.split(line.partition('!')[0].strip()) for line in prm)
+                # Read up to the number of loops, which follows the n aberrations. The loop
+                # definitions after it are not needed.
+                content = list(itertools.islice(lines, 18))
+                n = int(content[17][0])
+                content += itertools.islice(lines, 3 + n)
+                # read lines to dictionary wavimg_dict
+                for (name, types, comment), tokens in zip(_SCHEMA_HEAD, content):
+                    setattr(self, name, _parse_entries(name, tokens, types))
+                # self.number_of_aber = n
+                for index, coeff_1, coeff_2, *_ in content[18:18 + n]:
+                    aberrations_dict[int(index)] = (float(coeff_1), float(coeff_2))
+                self.aberrations_dict = aberrations_dict
+                for (name, types, comment), tokens in zip(_SCHEMA_TAIL, content[18 + n:]):
+                    setattr(self, name, _parse_entries(name, tokens, types))
+
+            if use_cache:
+                attributes = {name: getattr(self, name) for name in _LOADED_ATTRIBUTES}
+                attributes['aberrations_dict'] = dict(aberrations_dict)
+                _PRM_CACHE[prm_filename] = signature + (attributes,)
 
         if output:
             print("Parameters successfully loaded from file '{}'!".format(prm_filename))
 
+    @classmethod
+    def load_many(cls, prm_filenames, max_workers=None):
+        """
+        Loads several parameterfiles in parallel worker processes.
+
+        Parameters
+        ----------
+        prm_filenames : iterable of str
+            The names of the parameterfiles.
+        max_workers : int, optional
+            Number of worker processes. Defaults to the number of processors.
+
+        Returns
+        -------
+        list of WavimgPrm
+            One object per parameterfile, in the order of 'prm_filenames'.
+
+        Notes
+        -----
+        On Windows and macOS the worker processes import the calling script, which therefore
+        has to guard its own code with ``if __name__ == '__main__':``.
+        """
+        with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+            # Send the files in chunks to amortise the transfer of the objects between processes
+            return list(executor.map(functools.partial(_load, cls), prm_filenames, chunksize=8))
+
     def save_wavimg_prm(self, prm_filename, output=False):
         """
         Saves the WavimgPrm object in the parameterfile 'prm_filename'.
@@ -246,129 +404,50 @@ class WavimgPrm(object):
         output : bool, optional
             Flag for terminal output
         """
-
-        # directory = prm_filename.rsplit('/', 1)[0]
-        directory = os.path.split(prm_filename)[0]
+        directory = os.path.dirname(prm_filename)
         if directory:
-            if not os.path.isdir(directory):
-                os.makedirs(directory, exist_ok=True)
-
-        aberrations = {0: 'image_shift',
-                       1: 'defocus',
-                       2: '2-fold-astigmatism',
-                       3: 'coma',
-                       4: '3-fold-astigmatism',
-                       5: 'CS',
-                       6: 'star_aberration',
-                       7: '4-fold-astigmatism',
-                       8: 'coma(5th)',
-                       9: 'lobe-aberration',
-                       10: '5-fold-astigmatism',
-                       11: 'C5'}
-
-        with open(prm_filename, 'w') as prm:
-            string_1 = "Wave function file name string used to locate existing wave functions. " \
-                       "Use quotation marks when the string includes space characters."
-            prm.write("'{}' ! {}\n".format(self.wave_files, string_1))
-            string_2 = "Dimension of the wave data in pixels, <nx> = number of horizontal wave " \
-                       "pixels, <ny> = number of vertical wave pixels."
-            prm.write("{}, {} ! {}\n".format(self.wave_dim[0], self.wave_dim[1], string_2))
-            string_3 = "Sampling rate of the wave data (<sx> = horizontal, <sy> = vertical) [" \
-                       "nm/pix]."
-            prm.write("{}, {} ! {}\n".format(self.wave_sampling[0], self.wave_sampling[1],
-                                             string_3))
-            string_4 = "TEM high-tension used for wave function calculation [kV]."
-            prm.write("{} ! {}\n".format(self.high_tension, string_4))
-            string_5 = "Image output type option: 0 = TEM image, 1 = complex image plane wave, " \
-                       "2 = wave amplitude, 3 = wave phase, 4 = wave real part, 5 = wave " \
-                       "imaginary part, 6 = TEM image map of 2 variables."
-            prm.write("{} ! {}\n".format(self.output_format, string_5))
-            string_6 = "Image output file name string. Use quotation marks when the string " \
-                       "includes space characters."
-            prm.write("'{}' ! {}\n".format(self.output_files, string_6))
-            string_7 = "Image output size (<ix> = horizontal , <iy> = vertical) in number of " \
-                       "pixels."
-            prm.write("{}, {} ! {}\n".format(self.output_dim[0], self.output_dim[1], string_7))
-            string_8 = "Flag and parameters for creating integer images with optional noise. " \
-                       "Flag <intflg> 0 = off (default), 1 = 32-bit, 2 = 16-bit, Parameter: " \
-                       "<mean> = mean vacuum intensity, <conv> = electron to counts conversion " \
-                       "rate, <rnoise> detector readout rms noise level in counts."
-            prm.write("{}, {}, {}, {} ! {}\n".format(self.noise[0], self.noise[1], self.noise[2],
-                                                     self.noise[3], string_8))
-            string_9 = "Flag activating the extraction of a special image frame (0=OFF, " \
-                       "1=ON). The frame parameters are defined in the lines below."
-            prm.write("{} ! {}\n".format(self.flag_spec_frame, string_9))
-            string_10 = "Image output sampling rate [nm/pix], isotropic. The parameter is used " \
-                        "only if the Flag in line 09 is set to 1."
-            prm.write("{} ! {}\n".format(self.output_sampling, string_10))
-            string_11 = "Image frame offset in pixels of the input wave. The parameter is used " \
-                        "only if the Flag in line 09 is set to 1."
-            prm.write(str(self.img_frame_offset[0]) + ', ' + str(self.img_frame_offset[1]) +
-                      "{}, {} ! {}\n".format(self.img_frame_offset[0], self.img_frame_offset[1],
-                                             string_11))
-            string_12 = "Image frame rotation in [deg] with respect to the input wave " \
-                        "horizontal axis. The parameter is used only if the Flag in line 09 is " \
-                        "set to 1."
-            prm.write("{} ! {}\n".format(self.img_rot, string_12))
-            string_13 = "Coherence calculation model switch: 1 = averaging of coherent sub " \
-                        "images explicit focal variation but quasi-coherent spatial envelope, " \
-                        "2 = averaging of coherent sub images with explicit focal and angular " \
-                        "variation, 3 = quasi-coherent linear envelopes, 4 = Fourier-space " \
-                        "synthesis with  partially coherent TCC, 5: averaging of coherent sub " \
-                        "images with explicit  focal, angular, and frozen lattice variation)."
-            prm.write("{} ! {}\n".format(self.coherence_model, string_13))
-            string_14 = "Flag and parameters for partial temporal coherence: <ptcflg> = flag (" \
-                        "0=OFF, 1=ON), <f-spread> = focus spread (1/e) half width [nm]."
-            prm.write("{}, {} ! {}\n".format(self.temp_coherence[0], self.temp_coherence[1],
-                                             string_14))
-            string_15 = "Flag and parameters for partial spatial coherence: <pscflg> = flag (" \
-                        "0=OFF, 1=ON), <s-conv> = beam convergence (1/e) half width [mrad]."
-            prm.write("{}, {} ! {}\n".format(self.spat_coherence[0], self.spat_coherence[1],
-                                             string_15))
-            string_16 = "Flag and parameters for applying the detector MTF: <mtfflag> = flag (" \
-                        "0=OFF, 1=ON), <mtf-scale> = calculation scale of the mtf = (sampling " \
-                        "rate experiment)/(sampling rate simulation), <mtf-file> = File name " \
-                        "string to locate the MTF data. Use quotation marks when the string " \
-                        "includes space characters."
-            prm.write("{}, {}, '{}' ! {}\n".format(self.mtf[0], self.mtf[1], self.mtf[2],
-                                                   string_16))
-            string_17 = "Flag and parameters for a vibration envelope: <vibflg> = flag (0=OFF, " \
-                        "1=ON-ISO, 2=ON-ANISO), <vibprm1>, <vibprm1> = vibration RMS amplitudes " \
-                        "[nm], <vibprm3> = orientation [deg] of the primary vibration amplitude " \
-                        "w.r.t. the horizontal image axis."
-            prm.write("{}, {}, {}, {} ! {}\n".format(self.vibration[0], self.vibration[1],
-                                                     self.vibration[2], self.vibration[3],
-                                                     string_17))
-            string_18 = "Number of aberration definitions following this line."
-            prm.write("{} ! {}\n".format(self.number_of_aberrations, string_18))
-            for key in self.aberrations_dict:
-                prm.write('{} {:.4f} {:.4f} ! {}\n'.format(key, self.aberrations_dict[key][0],
-                                                           self.aberrations_dict[key][1],
-                                                           aberrations[key]))
-            #prm.write("{} ! {}\n".format(self.number_of_aberrations, string_18))
-            #for key in self.aberrations_dict:
-            #    prm.write('{}, {}, {} ! {}\n'.format(key, self.aberrations_dict[key][0],
-            #                          self.aberrations_dict[key][1], aberrations[key]))
-            string_19 = "Objective aperture radius [mrad]. Set to very large values to deactivate."
-            prm.write("{} ! {}\n".format(self.oa_radius, string_19))
-            string_20 = "Center of the objective aperture with respect to the zero beam [mrad]."
-            prm.write("{}, {} ! {}\n".format(self.oa_position[0], self.oa_position[1], string_20))
-            string_21 = "Number variable of loop definitions following below."
-            prm.write("{} ! {}".format(self.number_of_loops, string_21))
-
-        # Sort prm file
-        with open(prm_filename, 'r+') as prm:
-            content = prm.readlines()
-
-            length = []
-            for line in content:
-                length.append(len(line.rsplit('!', 1)[0]))
-
-            spacer = np.max(length)
-            prm.seek(0)
-            prm.truncate()
-            for line in content:
-                line = line.split('!')[0].ljust(spacer) + ' !' + line.split('!')[1]
-                prm.write(line)
+            os.makedirs(directory, exist_ok=True)
+
+        # Lines of the parameter file as (entry, comment)
+        rows = [(_format_entries(name, getattr(self, name), types), comment)
+                for name, types, comment in _SCHEMA_HEAD]
+        rows.append((str(self.number_of_aberrations), _COMMENT_18))
+        for key, (coeff_1, coeff_2) in self.aberrations_dict.items():
+            # Negative keys would silently index the labels from the end
+            if not 0 <= key < len(_ABERRATION_LABELS):
+                raise KeyError(key)
+            rows.append((f'{key} {coeff_1:.4f} {coeff_2:.4f}', _ABERRATION_LABELS[key]))
+        rows += ((_format_entries(name, getattr(self, name), types), comment)
+                 for name, types, comment in _SCHEMA_TAIL)
+
+        # Align the comments in one column behind the longest entry
+        spacer = max(len(entry) for entry, comment in rows)
+        lines = [f'{entry:<{spacer}} ! {comment}' for entry, comment in rows]
+
+        # Encode before touching the file and replace it only once the new content is complete,
+        # so that a failed or interrupted save leaves the previous parameter file intact.
+        data = os.linesep.join(lines).encode('ascii', 'surrogateescape')
+        # Write a uniquely named temporary file next to the resolved target, so that concurrent
+        # saves do not write into each other, os.replace stays on one file system and a
+        # symlinked parameter file keeps its link. It is created with the usual permissions.
+        target = os.path.realpath(prm_filename)
+        tmp_filename = f'{target}.{os.getpid()}.{os.urandom(4).hex()}.tmp'
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+        fd = os.open(tmp_filename, flags, 0o666)
+        try:
+            with os.fdopen(fd, 'wb') as prm:
+                prm.write(data)
+            os.replace(tmp_filename, target)
+        except BaseException:
+            os.unlink(tmp_filename)
+            raise
+
         if output:
             print("Parameters successfully saved to file '{}'!".format(prm_filename))
+
+
+def _load(cls, prm_filename):
+    """Returns a new 'cls' object loaded from 'prm_filename'. Runs in the load_many workers."""
+    wavimg = cls()
+    wavimg.load_wavimg_prm(prm_filename)
+    return wavimg
@@ -1,10 +1,19 @@
+import os
 import setuptools
 
+# Set DRPROBE_USE_MYPYC=1 to compile the command wrappers and the wavimg parameter file parser
+# to C extensions with mypyc.
+ext_modules = []
+if os.environ.get('DRPROBE_USE_MYPYC') == '1':
+    from mypyc.build import mypycify
+    ext_modules = mypycify(['drprobe/commands.py', 'drprobe/wavimgprm.py'])
+
 setuptools.setup(
     name="drprobe_interface",
     version='0.1.25',
     url='https://github.com/FWin22/drprobe_interface',
     packages=setuptools.find_packages(),
+    ext_modules=ext_modules,
     author='Florian Winkler',
     author_email='flowinkler22@gmail.com',
     description='Python interface to the Dr Probe software package',